@@ -107,32 +107,39 @@ class AugmentationLayer(Layer):
             'hue_range': self.hue_range
         }
         base_config = super(AugmentationLayer, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        return {**base_config, **config}
 
 
 class ProjectionLayer(Layer):
     """Projective inverse warping layer. Initialize with the camera 
     intrinsics matrix which is kept constant during training.
     """
+    # Scaling applied to the whole 6DoF pose vector (translation and
+    # rotation), hence it cannot be folded into the intrinsics matrix
+    POSE_SCALING = 0.001
+
     def __init__(self, intrinsics_mat=None, **kwargs):
-        self.POSE_SCALING = 0.001
-        self.intrinsics_mat = intrinsics_mat
+        # Keep intrinsics in float32 to match the warping computations
+        self.intrinsics_mat = np.asarray(intrinsics_mat, dtype=np.float32)
         self.intrinsics_mat_inv = np.linalg.inv(self.intrinsics_mat)
         super(ProjectionLayer, self).__init__(**kwargs)
 
     def build(self, input_shape):
-        self.intrinsics_mat_tensor = K.variable(self.intrinsics_mat)
-        self.intrinsics_mat_inv_tensor = K.variable(self.intrinsics_mat_inv)
+        self.intrinsics_mat_tensor = tf.constant(self.intrinsics_mat,
+                                                 dtype=tf.float32)
+        self.intrinsics_mat_inv_tensor = tf.constant(self.intrinsics_mat_inv,
+                                                     dtype=tf.float32)
         super(ProjectionLayer, self).build(input_shape)
 
     def call(self, x):
-        source_img = x[0]
-        depth_map = x[1]
-        pose = x[2] * self.POSE_SCALING
+        # Warp in float32 even when fed reduced precision inputs
+        source_img = tf.cast(x[0], tf.float32)
+        depth_map = tf.cast(x[1], tf.float32)
+        pose = tf.cast(x[2], tf.float32) * self.POSE_SCALING
         reprojected_img, _ = inverse_warp(source_img, depth_map, pose,
                                           self.intrinsics_mat_tensor,
                                           self.intrinsics_mat_inv_tensor)
-        return reprojected_img
+        return tf.cast(reprojected_img, x[0].dtype)
 
     def compute_output_shape(self, input_shape):
         return input_shape[0]
@@ -142,7 +149,7 @@ class ProjectionLayer(Layer):
             'intrinsics_mat': self.intrinsics_mat
         }
         base_config = super(ProjectionLayer, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        return {**base_config, **config}
 
 
 class ReflectionPadding2D(Layer):
@@ -167,7 +174,7 @@ class ReflectionPadding2D(Layer):
             'padding': self.padding
         }
         base_config = super(ReflectionPadding2D, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        return {**base_config, **config}
 
 
 class InverseDepthNormalization(Layer):
@@ -181,11 +188,21 @@ class InverseDepthNormalization(Layer):
         self.max_disp = 1 / min_depth
         super(InverseDepthNormalization, self).__init__(**kwargs)
 
+    def build(self, input_shape):
+        self.min_disp_tensor = tf.constant(self.min_disp, dtype=tf.float32)
+        self.disp_range_tensor = tf.constant(self.max_disp - self.min_disp,
+                                             dtype=tf.float32)
+        super(InverseDepthNormalization, self).build(input_shape)
+
     def call(self, x):
-        normalized_disp = (self.min_disp
-                           + (self.max_disp - self.min_disp) * x)
-        depth_map = 1 / normalized_disp
-        return depth_map
+        # Normalize in float32, 1 / disp loses too much precision in float16
+        disp = tf.cast(x, tf.float32)
+        # Multiply-add and reciprocal, fused into one kernel by XLA
+        normalized_disp = tf.math.add(
+            self.min_disp_tensor, tf.math.multiply(self.disp_range_tensor,
+                                                   disp))
+        depth_map = tf.math.reciprocal(normalized_disp)
+        return tf.cast(depth_map, x.dtype)
 
     def compute_output_shape(self, input_shape):
         return input_shape
@@ -196,10 +213,16 @@ class InverseDepthNormalization(Layer):
             'max_depth': self.max_depth
         }
         base_config = super(InverseDepthNormalization, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        return {**base_config, **config}
 
 
 class Losses():
+    # As defined in SSIM to stabilize div. by small denom.
+    SSIM_C1 = 0.01**2
+    SSIM_C2 = 0.03**2
+    # Padding to maintain img size after 3x3 pooling
+    SSIM_PADDING = ((0,0), (1,1), (1,1), (0,0))
+
     def reprojection_loss(self, alpha=0.85, masking=True):
         """Creates reprojection loss function combining MAE and SSIM losses.
         The reprojection loss is computed per scale by choosing the minimum
@@ -212,27 +235,24 @@ class Losses():
         """
         def reprojection_loss_keras(y_true, y_pred):
             source_loss = y_pred[:,:,:,:3]
-            reprojection_prev = y_pred[:,:,:,3:6]
-            reprojection_next = y_pred[:,:,:,6:9]
-
-            # Reprojection MAE
-            reprojection_prev_mae = K.mean(K.abs(y_true - reprojection_prev),
-                                           axis=-1, keepdims=True)
-            reprojection_next_mae = K.mean(K.abs(y_true - reprojection_next),
-                                           axis=-1, keepdims=True)
-            scale_min_mae = K.minimum(reprojection_prev_mae, 
-                                      reprojection_next_mae)
-            # Reprojection SSIM
-            reprojection_prev_ssim = self.__ssim(y_true, reprojection_prev)
-            reprojection_next_ssim = self.__ssim(y_true, reprojection_next)
-            scale_min_ssim = K.minimum(reprojection_prev_ssim,
-                                       reprojection_next_ssim)
+            reprojections = y_pred[:,:,:,3:9]
+
+            # Reprojection MAE, computed on the stacked [prev, next] pair
+            reprojection_mae = K.mean(
+                K.abs(K.expand_dims(y_true, axis=3)
+                      - self.__split_pair_axis(reprojections)), axis=-1)
+            scale_min_mae = K.min(reprojection_mae, axis=-1, keepdims=True)
+            # Reprojection SSIM (both reprojections in a single pass)
+            reprojection_ssim = self.__ssim(y_true, reprojections)
+            scale_min_ssim = K.min(
+                self.__split_pair_axis(reprojection_ssim), axis=3)
             # Total loss
             reprojection_loss = (alpha * scale_min_ssim 
                                  + (1 - alpha) * scale_min_mae)
             if masking:
                 mask = K.less(reprojection_loss, source_loss)
-                reprojection_loss *= K.cast(mask, 'float32')
+                reprojection_loss = tf.where(
+                    mask, reprojection_loss, tf.zeros_like(reprojection_loss))
 
             return reprojection_loss
 
@@ -243,19 +263,16 @@ class Losses():
         as reprojections.
         """
         y_true = x[0]
-        prev_frame = x[1]
-        next_frame = x[2]
-
-        # Source frame MAE
-        prev_mae = K.mean(K.abs(y_true - prev_frame), axis=-1,
-                          keepdims=True)
-        next_mae = K.mean(K.abs(y_true - next_frame), axis=-1,
-                          keepdims=True)
-        source_min_mae  = K.minimum(prev_mae, next_mae)
-        # Source frame SSIM
-        prev_ssim = self.__ssim(y_true, prev_frame)
-        next_ssim = self.__ssim(y_true, next_frame)
-        source_min_ssim = K.minimum(prev_ssim, next_ssim)
+        source_frames = K.concatenate([x[1], x[2]], axis=-1)
+
+        # Source frame MAE, computed on the stacked [prev, next] pair
+        source_mae = K.mean(
+            K.abs(K.expand_dims(y_true, axis=3)
+                  - self.__split_pair_axis(source_frames)), axis=-1)
+        source_min_mae = K.min(source_mae, axis=-1, keepdims=True)
+        # Source frame SSIM (both frames in a single pass)
+        source_ssim = self.__ssim(y_true, source_frames)
+        source_min_ssim = K.min(self.__split_pair_axis(source_ssim), axis=3)
         source_loss = (alpha * source_min_ssim
                        + (1 - alpha) * source_min_mae)
         return source_loss
@@ -271,11 +288,14 @@ class Losses():
             # Normalize inverse depth by mean
             inverse_depth = y_pred / (tf.reduce_mean(y_pred, axis=[1,2,3], 
                                       keepdims=True) + 1e-7)
-            # Compute depth smoothness loss
-            inverse_depth_dx = self.__gradient_x(inverse_depth)
-            inverse_depth_dy = self.__gradient_y(inverse_depth)
-            image_dx = self.__gradient_x(img)
-            image_dy = self.__gradient_y(img)
+            # Compute depth smoothness loss, with the inverse depth and
+            # image gradients computed together on the stacked channels
+            gradients_x, gradients_y = self.__gradients(
+                K.concatenate([inverse_depth, img], axis=-1))
+            inverse_depth_dx = gradients_x[:,:,:,:1]
+            inverse_depth_dy = gradients_y[:,:,:,:1]
+            image_dx = gradients_x[:,:,:,1:]
+            image_dy = gradients_y[:,:,:,1:]
             weights_x = tf.exp(-tf.reduce_mean(tf.abs(image_dx), 3, 
                                                keepdims=True))
             weights_y = tf.exp(-tf.reduce_mean(tf.abs(image_dy), 3,
@@ -292,44 +312,76 @@ class Losses():
         Taken from:
             https://github.com/tensorflow/models/tree/master/research/struct2depth
         Modified by Alexander Graikos.
+
+        Inputs:
+            x: Reference image batch [B,H,W,C].
+            y: Image pair to compare against x, stacked along the
+               channel axis [B,H,W,2*C].
+        Outputs:
+            ssim: Per-pixel SSIM loss [B,H,W,2*C].
         """
-        c1 = 0.01**2  # As defined in SSIM to stabilize div. by small denom.
-        c2 = 0.03**2
-        # Add padding to maintain img size
-        x = tf.pad(x, [[0,0], [1,1], [1,1], [0,0]], 'REFLECT')
-        y = tf.pad(y, [[0,0], [1,1], [1,1], [0,0]], 'REFLECT')
-        mu_x = K.pool2d(x, (3,3), (1,1), 'valid', pool_mode='avg')
-        mu_y = K.pool2d(y, (3,3), (1,1), 'valid', pool_mode='avg')
-        sigma_x = (K.pool2d(x**2, (3,3), (1,1), 'valid', pool_mode='avg')
-                   - mu_x**2)
-        sigma_y = (K.pool2d(y**2, (3,3), (1,1), 'valid', pool_mode='avg')
-                   - mu_y**2)
-        sigma_xy = (K.pool2d(x * y, (3,3), (1,1), 'valid', pool_mode='avg') 
-                    - mu_x * mu_y)
+        c1 = self.SSIM_C1
+        c2 = self.SSIM_C2
+        # Repeat reference image to match the stacked image pair
+        x = K.concatenate([x, x], axis=-1)
+        # Stack all local statistics inputs to pool them in a single pass
+        stacked = K.concatenate([x, y, x * x, y * y, x * y], axis=-1)
+        stacked = tf.pad(stacked, self.SSIM_PADDING, 'REFLECT')
+        pooled = K.pool2d(stacked, (3,3), (1,1), 'valid', pool_mode='avg')
+        mu_x, mu_y, e_xx, e_yy, e_xy = tf.split(pooled, 5, axis=-1)
+        sigma_x = e_xx - mu_x**2
+        sigma_y = e_yy - mu_y**2
+        sigma_xy = e_xy - mu_x * mu_y
         ssim_n = (2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)
         ssim_d = (mu_x**2 + mu_y**2 + c1) * (sigma_x + sigma_y + c2)
         ssim = ssim_n / ssim_d
         return K.clip((1 - ssim) / 2, 0, 1)
 
-    def __gradient_x(self, img):
-        return img[:, :, :-1, :] - img[:, :, 1:, :]
+    def __split_pair_axis(self, x):
+        """Splits channel-stacked image pairs into a separate pair axis,
+        [B,H,W,2*C] -> [B,H,W,2,C].
+        """
+        # Keep statically known dims so that Keras can infer output shapes
+        shape = [d if d is not None else tf.shape(x)[i]
+                 for i, d in enumerate(K.int_shape(x))]
+        return K.reshape(x, shape[:3] + [2, shape[3] // 2])
+
+    def __gradients(self, img):
+        """Computes horizontal and vertical image gradients as depthwise
+        convolutions with a fixed [1,-1] kernel.
 
-    def __gradient_y(self, img):
-        return img[:, :-1, :, :] - img[:, 1:, :, :]
+        Inputs:
+            img: Input image batch [B,H,W,C].
+        Outputs:
+            gradient_x: Horizontal gradients [B,H,W-1,C].
+            gradient_y: Vertical gradients [B,H-1,W,C].
+        """
+        channels = tf.shape(img)[-1]
+        kernel = tf.constant([1.0, -1.0])
+        kernel_x = tf.tile(tf.reshape(kernel, [1, 2, 1, 1]),
+                           [1, 1, channels, 1])
+        kernel_y = tf.tile(tf.reshape(kernel, [2, 1, 1, 1]),
+                           [1, 1, channels, 1])
+        gradient_x = tf.nn.depthwise_conv2d(img, kernel_x, [1, 1, 1, 1],
+                                            'VALID')
+        gradient_y = tf.nn.depthwise_conv2d(img, kernel_y, [1, 1, 1, 1],
+                                            'VALID')
+        return gradient_x, gradient_y
 
 
 class NumpyEncoder(json.JSONEncoder):
     """JSON encoder for numpy types."""
     def default(self, obj):
-        if isinstance(obj, (np.int_, np.intc, np.intp, np.int8,
-                            np.int16, np.int32, np.int64, np.uint8,
-                            np.uint16, np.uint32, np.uint64)):
-            return int(obj)
-        elif isinstance(obj, (np.float_, np.float16, np.float32, 
-                              np.float64)):
-            return float(obj)
-        elif isinstance(obj,(np.ndarray,)):
+        if isinstance(obj, np.ndarray):
+            # Converts all elements at once, scalars never reach default()
             return obj.tolist()
+        elif isinstance(obj, np.generic):
+            kind = obj.dtype.kind
+            if kind in 'iu':
+                return int(obj)
+            elif kind == 'f':
+                return float(obj)
+            return obj.item()
         return json.JSONEncoder.default(self, obj)
 
 
@@ -376,25 +428,20 @@ class DataGenerator(Sequence):
         Outputs:
             ([inputs], [outputs]) tuple for model training.
         """
-        # Load file paths to current batch images
-        curr_batch_fp = self.data_df.iloc[
-            idx * self.batch_size : (idx + 1) * self.batch_size, 0].values
-        prev_batch_fp = self.data_df.iloc[
-            idx * self.batch_size : (idx + 1) * self.batch_size, 1].values
-        next_batch_fp = self.data_df.iloc[
-            idx * self.batch_size : (idx + 1) * self.batch_size, 2].values
-
-        # Load and flip horizontally with probability 0.5
+        # Load file paths to current batch triplets
+        batch_fp = self.data_df.iloc[
+            idx * self.batch_size : (idx + 1) * self.batch_size, :3].values
+
+        # Load all frames of each triplet into a preallocated array and
+        # flip horizontally with probability 0.5
         horizontal_flips = np.random.rand(self.batch_size) > 0.5
-        curr_frame = np.array(
-            [self.__read_img(curr_batch_fp[i], horizontal_flips[i])
-             for i in range(curr_batch_fp.shape[0])])
-        prev_frame = np.array(
-            [self.__read_img(prev_batch_fp[i], horizontal_flips[i])
-             for i in range(prev_batch_fp.shape[0])])
-        next_frame = np.array(
-            [self.__read_img(next_batch_fp[i], horizontal_flips[i])
-             for i in range(next_batch_fp.shape[0])])
+        frames = np.empty((3, batch_fp.shape[0]) + self.target_size[::-1]
+                          + (3,), dtype=np.float32)
+        for i in range(batch_fp.shape[0]):
+            for j in range(3):
+                frames[j,i] = self.__read_img(batch_fp[i,j],
+                                              horizontal_flips[i])
+        curr_frame, prev_frame, next_frame = frames
 
         # Return (inputs,outputs) tuple
         curr_frame_list = [curr_frame for _ in range(4)]
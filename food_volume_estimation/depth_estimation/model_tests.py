@@ -86,6 +86,9 @@ class ModelTests:
         parser.add_argument('--n_tests', type=int,
                             help='Number of tests.',
                             default=1)
+        parser.add_argument('--no_plot', action='store_true',
+                            help='Skip plotting of test results.',
+                            default=False)
         args = parser.parse_args()
         return args
     
@@ -113,7 +116,8 @@ class ModelTests:
             depth = self.__inverse_depth_normalization(inverse_depth)
             self.__pretty_plotting([test_data[0], depth], (1,2),
                                    ['Input Frame', 'Predicted Depth'])
-            plt.show()
+            if not self.args.no_plot:
+                plt.show()
 
     def test_outputs(self, n_tests):
         """Plots outputs of model on input images.
@@ -176,7 +180,8 @@ class ModelTests:
             depth_titles = ['Inferred Depth (S1)', 'Inferred Depth (S2)',
                             'Inferred Depth (S3)', 'Inferred Depth (S4)']
             self.__pretty_plotting(depths, (2,2), depth_titles)
-            plt.show()
+            if not self.args.no_plot:
+                plt.show()
 
     def __set_weights_trainable(self, model, trainable):
         """Sets model weights to trainable/non-trainable.
@@ -193,8 +198,9 @@ class ModelTests:
     def __inverse_depth_normalization(self, x):
         min_disp = 1 / self.depth_range[1]
         max_disp = 1 / self.depth_range[0]
-        normalized_disp = (min_disp + (max_disp - min_disp) * x)
-        depth_map = 1 / normalized_disp
+        # Keep the computation in float32 to avoid a float64 upcast
+        x = np.asarray(x, dtype=np.float32)
+        depth_map = 1 / (min_disp + (max_disp - min_disp) * x)
         return depth_map
 
     def __pretty_plotting(self, imgs, tiling, titles):
@@ -205,14 +211,17 @@ class ModelTests:
             tiling: Subplot tiling tuple (rows,cols).
             titles: List of subplot titles.
         """
+        if self.args.no_plot:
+            return
         n_plots = len(imgs)
         rows = str(tiling[0])
         cols = str(tiling[1])
-        plt.figure()
+        # Reuse the figure of previous tests instead of creating a new one
+        plt.figure(titles[0], clear=True)
         for r in range(tiling[0] * tiling[1]):
             plt.subplot(rows + cols + str(r + 1))
             plt.title(titles[r])
-            plt.imshow(imgs[r])
+            plt.imshow(imgs[r], interpolation='nearest')
 
 
 
@@ -6,6 +6,26 @@ from sklearn import linear_model
 import matplotlib.pyplot as plt
 
 
+def depth_to_point_cloud(depth, intrinsics_inv):
+    """Convert depth map to 3D point cloud, by back-projecting each pixel
+    with the inverse intrinsics matrix.
+
+    Inputs:
+        depth: Depth map HxW.
+        intrinsics_inv: Inverse of the intrinsics matrix [3x3].
+    Returns:
+        point_cloud: Point cloud 1xHxWx3.
+    """
+    height, width = depth.shape
+    # Homogeneous pixel coordinates (x,y,1) in row-major pixel order
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    grid = np.stack((x.ravel(), y.ravel(), np.ones(height * width,
+                                                   dtype=np.float32)))
+    cam_coords = (np.dot(intrinsics_inv.astype(np.float32), grid)
+                  * depth.ravel())
+    point_cloud = np.reshape(cam_coords.T, (1, height, width, 3))
+    return point_cloud
+
 def linear_plane_estimation(points):
     """Find the plane that best fits the input points using ordinary 
     least squares.
@@ -222,14 +222,12 @@ class VolumeEstimator():
 
         # Predict depth
         img_batch = np.reshape(img, (1,) + img.shape)
-        inverse_depth = self.depth_model.predict(img_batch)[0][0,:,:,0] 
+        inverse_depth = self.depth_model.predict_on_batch(img_batch)[0][0,:,:,0]
         disparity_map = (self.min_disp + (self.max_disp - self.min_disp) 
                          * inverse_depth)
         depth = 1 / disparity_map
         # Convert depth map to point cloud
-        depth_tensor = K.variable(np.expand_dims(depth, 0))
-        intrinsics_inv_tensor = K.variable(np.expand_dims(intrinsics_inv, 0))
-        point_cloud = K.eval(get_cloud(depth_tensor, intrinsics_inv_tensor))
+        point_cloud = depth_to_point_cloud(depth, intrinsics_inv)
         point_cloud_flat = np.reshape(
             point_cloud, (point_cloud.shape[1] * point_cloud.shape[2], 3))
 
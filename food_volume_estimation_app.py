@@ -1,8 +1,14 @@
 import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import numpy as np
 import cv2
 import tensorflow as tf
 from keras.models import Model, model_from_json
+from keras.layers import Input
 from food_volume_estimation.volume_estimator import VolumeEstimator, DensityDatabase
 from food_volume_estimation.depth_estimation.custom_modules import *
 from food_volume_estimation.food_segmentation.food_segmentator import FoodSegmentator
@@ -13,8 +19,88 @@ import base64
 app = Flask(__name__)
 estimator = None
 
+
+class DepthBatcher():
+    """Micro-batching wrapper around the depth model. Concurrent
+    predictions are collected for a short time window and run as a
+    single batch, the outputs are then scattered back to the callers.
+    """
+    def __init__(self, depth_model, graph, max_batch_size=8,
+            batch_window=0.01):
+        """Starts the batching worker thread.
+
+        Inputs:
+            depth_model: Depth model to run predictions with.
+            graph: Graph the depth model was created in.
+            max_batch_size: Maximum number of images per batch.
+            batch_window: Time to wait for more requests (in s).
+        """
+        self.depth_model = depth_model
+        self.graph = graph
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.requests = queue.Queue()
+        worker = threading.Thread(target=self.__process_requests,
+                                  daemon=True)
+        worker.start()
+
+    def predict_on_batch(self, x):
+        """Queues input batch for prediction and waits for the outputs.
+
+        Inputs:
+            x: Input image batch.
+        Returns:
+            outputs: List of depth model outputs for the input batch.
+        """
+        future = Future()
+        self.requests.put((x, future))
+        return future.result()
+
+    def __process_requests(self):
+        with self.graph.as_default():
+            while True:
+                batch = [self.requests.get()]
+                try:
+                    self.__process_batch(batch)
+                except Exception as e:
+                    # Never leave a request waiting on its future
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def __process_batch(self, batch):
+        """Collects pending requests into the batch, runs the depth model
+        and scatters the outputs back to the requests' futures.
+
+        Inputs:
+            batch: List of (input batch, future) pairs, extended in place.
+        """
+        batch_size = batch[0][0].shape[0]
+        deadline = time.monotonic() + self.batch_window
+        # Collect requests until the window closes or batch is full
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+            batch_size += batch[-1][0].shape[0]
+
+        outputs = self.depth_model.predict_on_batch(
+            np.concatenate([x for x, _ in batch], axis=0))
+        # Scatter outputs back to the waiting requests
+        start = 0
+        for x, future in batch:
+            end = start + x.shape[0]
+            future.set_result([o[start:end] for o in outputs])
+            start = end
+
+
 def load_volume_estimator(depth_model_architecture, depth_model_weights,
-        segmentation_model_weights, relaxation_param: float = 0.01):
+        segmentation_model_weights, relaxation_param: float = 0.01,
+        xla_jit: bool = False, max_batch_size: int = 8):
     """Loads volume estimator object and sets up its parameters."""
     # Create estimator object and intialize
     global estimator
@@ -35,9 +121,28 @@ def load_volume_estimator(depth_model_architecture, depth_model_weights,
     estimator.model_input_shape = (
         estimator.monovideo.inputs[0].shape.as_list()[1:])
     depth_net = estimator.monovideo.get_layer('depth_net')
-    estimator.depth_model = Model(inputs=depth_net.inputs,
-                                  outputs=depth_net.outputs,
-                                  name='depth_model')
+    if xla_jit:
+        # Re-create the depth net ops inside a JIT scope, marking only the
+        # depth model (not the segmentation model) for XLA compilation.
+        # Intended for GPU builds of TensorFlow.
+        with tf.contrib.compiler.jit.experimental_jit_scope():
+            depth_input = Input(shape=estimator.model_input_shape)
+            estimator.depth_model = Model(inputs=depth_input,
+                                          outputs=depth_net(depth_input),
+                                          name='depth_model')
+    else:
+        estimator.depth_model = Model(inputs=depth_net.inputs,
+                                      outputs=depth_net.outputs,
+                                      name='depth_model')
+    # Warm up the depth model so that the first request does not pay
+    # for building the predict function and compiling the graph. XLA
+    # compiles per input shape, so warm up every batch size the depth
+    # batcher can produce.
+    warm_up_sizes = range(1, max_batch_size + 1) if xla_jit else [1]
+    for batch_size in warm_up_sizes:
+        estimator.depth_model.predict_on_batch(
+            np.zeros((batch_size,) + tuple(estimator.model_input_shape),
+                     dtype=np.float32))
     print('[*] Loaded depth estimation model.')
 
     # Depth model configuration
@@ -47,14 +152,22 @@ def load_volume_estimator(depth_model_architecture, depth_model_weights,
     estimator.max_disp = 1 / MIN_DEPTH
     estimator.gt_depth_scale = 0.35 # Ground truth expected median depth
 
-    # Create segmentator object
+    # Create segmentator object and warm it up, so that its predict
+    # function is built in the model graph before serving requests
     estimator.segmentator = FoodSegmentator(segmentation_model_weights)
+    estimator.segmentator.infer_masks(
+        np.zeros(tuple(estimator.model_input_shape[:2]) + (3,),
+                 dtype=np.uint8))
     # Set plate adjustment relaxation parameter
     estimator.relax_param = relaxation_param
 
-    # Need to define default graph due to Flask multiprocessing
-    global graph
-    graph = tf.get_default_graph()
+    # Batch depth predictions of concurrent requests. The batching
+    # thread enters the model graph once, request threads only run
+    # already built predict functions and need no graph context.
+    if max_batch_size > 1:
+        estimator.depth_model = DepthBatcher(estimator.depth_model,
+                                             tf.get_default_graph(),
+                                             max_batch_size=max_batch_size)
 
 
 @app.route('/predict', methods=['POST'])
@@ -75,12 +188,10 @@ def volume_estimation():
         content = request.json
         img_encoded = content['img']
         jpg_original = base64.b64decode(img_encoded)
-        print("Test 1")
         img_arr = np.frombuffer(jpg_original, dtype=np.uint8)
-        print("Test 2")
         img = cv2.imdecode(img_arr, cv2.IMREAD_COLOR)
-        print("Test 3")
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        # Swap channels in place to avoid another image copy
+        cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst=img)
     except Exception as e:
         print(e)
         abort(406)
@@ -93,9 +204,8 @@ def volume_estimation():
         plate_diameter = 0
 
     # Estimate volumes
-    with graph.as_default():
-        volumes = estimator.estimate_volume(img, fov=content.get("fov", 70),
-            plate_diameter_prior=plate_diameter)
+    volumes = estimator.estimate_volume(img, fov=content.get("fov", 70),
+        plate_diameter_prior=plate_diameter)
     # Convert to mL
     volumes = [v * 1e6 for v in volumes]
 
@@ -129,11 +239,34 @@ if __name__ == '__main__':
                         help='Port the app will run on.',
                         metavar='<port>',
                         default=8080)
+    parser.add_argument('--max_batch_size', type=int,
+                        help=('Maximum number of concurrent requests to '
+                              'batch depth predictions for.'),
+                        metavar='<max_batch_size>',
+                        default=8)
+    parser.add_argument('--xla_jit', action='store_true',
+                        help=('Enable XLA JIT compilation of the depth '
+                              'model (only effective on GPU builds).'),
+                        default=False)
     args = parser.parse_args()
 
     load_volume_estimator(args.depth_model_architecture,
                           args.depth_model_weights, 
                           args.segmentation_model_weights,
-                          relaxation_param=args.relaxation_param)
+                          relaxation_param=args.relaxation_param,
+                          xla_jit=args.xla_jit,
+                          max_batch_size=args.max_batch_size)
     app.run(host='0.0.0.0', port=args.port)
+elif 'DEPTH_MODEL_ARCHITECTURE' in os.environ:
+    # Served by a WSGI server (e.g. gunicorn), load the models once at
+    # import time so that all request threads share them. Loading must
+    # happen in the worker process (no --preload), neither the TF session
+    # nor the batching thread survive a fork.
+    load_volume_estimator(
+        os.environ['DEPTH_MODEL_ARCHITECTURE'],
+        os.environ['DEPTH_MODEL_WEIGHTS'],
+        os.environ['SEGMENTATION_MODEL_WEIGHTS'],
+        relaxation_param=float(os.environ.get('RELAXATION_PARAM', 0.01)),
+        xla_jit=os.environ.get('XLA_JIT', '0') == '1',
+        max_batch_size=int(os.environ.get('MAX_BATCH_SIZE', 8)))
 